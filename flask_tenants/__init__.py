@@ -1,14 +1,20 @@
+import logging
 from .middleware import MultiTenancyMiddleware, create_tenancy, FlaskTenants
 from .models import BaseTenant, BaseDomain, db
 from .utils import register_event_listeners, register_engine_event_listeners
+from .context import current_tenant, TenantCtx
 from .exceptions import (TenantActivationError, TenantNotFoundError, SchemaRenameError, SchemaCreationError,
                          SchemaDropError, TableCreationError)
 
+# Library logging stays silent unless the application configures handlers
+logging.getLogger(__name__).addHandler(logging.NullHandler())
+
 
 def init_app(app, tenant_model=None, domain_model=None):
     flask_tenants = FlaskTenants(app, tenant_model, domain_model, db)
     flask_tenants.init()
 
 
-__all__ = ['init_app', 'BaseTenant', 'BaseDomain', 'create_tenancy', 'FlaskTenants', 'TenantActivationError',
-           'TenantNotFoundError', 'SchemaRenameError', 'SchemaCreationError', 'SchemaDropError', 'TableCreationError']
+__all__ = ['init_app', 'BaseTenant', 'BaseDomain', 'create_tenancy', 'FlaskTenants', 'current_tenant', 'TenantCtx',
+           'TenantActivationError', 'TenantNotFoundError', 'SchemaRenameError', 'SchemaCreationError', 'SchemaDropError',
+           'TableCreationError']
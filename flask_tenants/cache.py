@@ -0,0 +1,60 @@
+import threading
+import time
+
+_TTL = 60
+
+# tenant name -> (tenant id, deactivated, cached at)
+_tenant_cache = {}
+# tenant name -> cached at, for names that had no tenant row; bounded since names come from request hosts
+_missing_tenants = {}
+_MISSING_MAX = 4096
+# When every tenant was last loaded in bulk; warmed entries all expire together once this is _TTL old
+_warmed_at = None
+_lock = threading.Lock()
+
+
+def get_cached_tenant(name):
+    entry = _tenant_cache.get(name)
+    if entry is not None and time.monotonic() - entry[2] < _TTL:
+        return entry
+    return None
+
+
+def cache_tenant(name, tenant_id, deactivated):
+    entry = (tenant_id, deactivated, time.monotonic())
+    with _lock:
+        _tenant_cache[name] = entry
+    return entry
+
+
+def cache_tenants(rows):
+    # rows of (name, tenant id, deactivated) for every tenant, stored under a single lock acquisition
+    global _warmed_at
+    now = time.monotonic()
+    with _lock:
+        for name, tenant_id, deactivated in rows:
+            _tenant_cache[name] = (tenant_id, bool(deactivated), now)
+        _warmed_at = now
+
+
+def tenant_cache_expired():
+    # True before the first bulk load and once the entries it cached have expired
+    return _warmed_at is None or time.monotonic() - _warmed_at >= _TTL
+
+
+def is_missing_tenant(name):
+    cached_at = _missing_tenants.get(name)
+    return cached_at is not None and time.monotonic() - cached_at < _TTL
+
+
+def cache_missing_tenant(name):
+    with _lock:
+        if len(_missing_tenants) >= _MISSING_MAX:
+            _missing_tenants.clear()
+        _missing_tenants[name] = time.monotonic()
+
+
+def invalidate_tenant(name):
+    with _lock:
+        _tenant_cache.pop(name, None)
+        _missing_tenants.pop(name, None)
@@ -0,0 +1,11 @@
+from collections import namedtuple
+from contextvars import ContextVar
+
+TenantCtx = namedtuple('TenantCtx', ['id', 'name'])
+
+_current_tenant = ContextVar('current_tenant', default=None)
+
+
+def current_tenant():
+    # The TenantCtx resolved for the active request, or None outside tenant-scoped requests
+    return _current_tenant.get()
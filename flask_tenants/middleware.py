@@ -1,9 +1,13 @@
-from werkzeug.wrappers import Request
+from sqlalchemy import false, select
 from sqlalchemy.orm import scoped_session, sessionmaker
-from sqlalchemy.sql import text
-from flask import g, request, Blueprint, current_app
+from flask import g, request, Blueprint
 import logging
-from .utils import register_event_listeners, register_engine_event_listeners
+import threading
+from functools import lru_cache
+from .utils import register_event_listeners, register_engine_event_listeners, refresh_search_path
+from .cache import (get_cached_tenant, cache_tenant, cache_tenants, tenant_cache_expired, is_missing_tenant,
+                    cache_missing_tenant)
+from .context import TenantCtx, _current_tenant
 from .exceptions import *
 
 logger = logging.getLogger(__name__)
@@ -11,21 +15,33 @@ logger = logging.getLogger(__name__)
 DEFAULT_TENANT_URL_PREFIX = '/InTheBeginningWasTheWordAndTheWordWasWithGodAndTheWordWasGod'
 
 
+@lru_cache(maxsize=4096)
+def _classify_host(host, non_tenant_subdomains):
+    # Returns the tenant subdomain for a raw Host header, or None for non-tenant hosts
+    subdomain, dot, _ = host.partition(':')[0].lower().partition('.')  # Strip port, split off subdomain
+    if dot and subdomain not in non_tenant_subdomains:
+        return subdomain
+    return None
+
+
 class URLRewriteMiddleware:
     def __init__(self, app, non_tenant_subdomains=None, tenant_url_prefix=DEFAULT_TENANT_URL_PREFIX):
         self.app = app
-        self.non_tenant_subdomains = non_tenant_subdomains or ['www', 'localhost', 'local']
+        self.non_tenant_subdomains = frozenset(non_tenant_subdomains or ('www', 'localhost', 'local'))
         self.tenant_url_prefix = tenant_url_prefix
 
     def __call__(self, environ, start_response):
-        req = Request(environ)
-        host = req.host.split(':')[0]  # Extract host without port
-
-        if '.' in host and host.split('.')[0] not in self.non_tenant_subdomains:
-            subdomain = host.split('.')[0]
-            environ['PATH_INFO'] = f'{self.tenant_url_prefix}{req.path}'
+        # Read the host straight from the WSGI environ rather than building a werkzeug Request
+        host = environ.get('HTTP_HOST') or environ.get('SERVER_NAME', '')
+        # Dotless hosts (localhost, health checks against a bare name) never carry a tenant subdomain
+        subdomain = _classify_host(host, self.non_tenant_subdomains) if '.' in host else None
+
+        if subdomain is not None:
+            path = environ.get('PATH_INFO') or '/'
+            environ['PATH_INFO'] = self.tenant_url_prefix + path
             environ['HTTP_X_TENANT'] = subdomain
-            logger.debug(f"Rewriting URL for tenant '{subdomain}' with path '{req.path}'")
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug("Rewriting URL for tenant '%s' with path '%s'", subdomain, path)
 
         return self.app(environ, start_response)
 
@@ -40,30 +56,92 @@ class MultiTenancyMiddleware:
         if self.db is None:
             raise ValueError("Database instance must be provided")
 
+        with app.app_context():
+            self.engine = self.db.engine
+        self.Session = scoped_session(sessionmaker(bind=self.engine))
+        # Bounded by the number of active tenants a process keeps engines for
+        self._tenant_engine = lru_cache(maxsize=1024)(self._make_tenant_engine)
+        self._has_deactivated = hasattr(getattr(self.db.Model, 'Tenant', None), 'deactivated')
+        self._warm_lock = threading.Lock()
+
         app.before_request(self._before_request_func)
         app.teardown_request(self._teardown_request_func)
 
     def _before_request_func(self):
-        if not hasattr(current_app, 'db_session'):
-            current_app.db_session = scoped_session(sessionmaker(bind=self.db.engine))
-
-        g.db_session = current_app.db_session()
-        g.tenant = request.headers.get('X-TENANT', self.default_schema)
+        g.tenant = request.environ.get('HTTP_X_TENANT', self.default_schema)
         g.tenant_scoped = g.tenant != self.default_schema
-        if g.tenant != self.default_schema:
-            tenant_object = g.db_session.query(self.db.Model.Tenant).filter_by(name=g.tenant).first()
-            if tenant_object is None:
-                logger.debug(f"Tenant '{g.tenant}' not found.")
-                raise TenantNotFoundError
-
-            if hasattr(tenant_object, 'deactivated') and tenant_object.deactivated:
-                logger.debug(f"Tenant '{g.tenant}' is deactivated.")
+        if not g.tenant_scoped:
+            # Public requests need no schema translation, so share Flask-SQLAlchemy's own scoped session
+            g.db_session = self.db.session()
+        else:
+            cached = get_cached_tenant(g.tenant)
+            if cached is None:
+                if is_missing_tenant(g.tenant):
+                    raise TenantNotFoundError
+                cached = self._load_tenant(g.tenant)
+
+            if cached[1]:
+                if logger.isEnabledFor(logging.DEBUG):
+                    logger.debug("Tenant '%s' is deactivated.", g.tenant)
                 raise TenantActivationError
 
-            g.db_session.execute(text("SET search_path TO :tenant, public"), {'tenant': g.tenant})
+            # Only validated tenants get an engine and session, so arbitrary hosts cannot evict real tenants
+            # from the engine cache
+            g.db_session = self.Session(bind=self._tenant_engine(g.tenant))
+            g._tenant_token = _current_tenant.set(TenantCtx(cached[0], g.tenant))
+            # db.session may already be in a transaction opened by an earlier before_request handler
+            refresh_search_path(self.db.session())
+
+    def _make_tenant_engine(self, tenant):
+        # Tables declared with schema 'tenant' are rewritten client-side at compile time
+        return self.engine.execution_options(schema_translate_map={'tenant': tenant})
+
+    def _deactivated_column(self, tenant_model):
+        return tenant_model.deactivated if self._has_deactivated else false()
+
+    def _load_tenant(self, name):
+        # Once the last bulk load has expired, one query reloads every tenant instead of each expired entry
+        # being fetched on its own; in between, names the bulk load did not see are looked up individually
+        if tenant_cache_expired():
+            with self._warm_lock:
+                # Threads that queued behind the lock reuse the reload that just finished
+                if tenant_cache_expired():
+                    self._warm_tenant_cache()
+            cached = get_cached_tenant(name)
+        else:
+            row = self._lookup_tenant(name)
+            cached = cache_tenant(name, row[0], bool(row[1])) if row is not None else None
+
+        if cached is None:
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug("Tenant '%s' not found.", name)
+            cache_missing_tenant(name)
+            raise TenantNotFoundError
+        return cached
+
+    def _lookup_tenant(self, name):
+        # Fetch only the columns needed instead of materializing a full Tenant instance. The lookup runs on its
+        # own short-lived connection, not on g.db_session: the search_path is set when a transaction begins,
+        # so the request session must not start its transaction before the tenant is known
+        tenant_model = self.db.Model.Tenant
+        with self.engine.connect() as conn:
+            return conn.execute(select(tenant_model.id, self._deactivated_column(tenant_model)).where(
+                tenant_model.name == name)).first()
+
+    def _warm_tenant_cache(self):
+        # Load every tenant in one query, instead of one query per tenant on a cold or expired cache
+        tenant_model = self.db.Model.Tenant
+        with self.engine.connect() as conn:
+            cache_tenants(conn.execute(select(
+                tenant_model.name, tenant_model.id, self._deactivated_column(tenant_model))).all())
+
     def _teardown_request_func(self, exception=None):
-        if hasattr(g, 'db_session'):
-            current_app.db_session.remove()
+        token = g.pop('_tenant_token', None)
+        if token is not None:
+            _current_tenant.reset(token)
+
+        # remove() is a no-op when no session was created for this request
+        self.Session.remove()
 
 
 def create_tenancy(app, db, non_tenant_subdomains=None, tenant_url_prefix=DEFAULT_TENANT_URL_PREFIX):
@@ -15,7 +15,7 @@ class BaseTenant(db.Model):
 class BaseDomain(db.Model):
     __abstract__ = True
     id = db.Column(db.Integer, primary_key=True, autoincrement=True)
-    tenant_name = db.Column(db.String(128), db.ForeignKey('tenants.name'), nullable=False)
+    tenant_name = db.Column(db.String(128), db.ForeignKey('tenants.name'), nullable=False, index=True)
     domain_name = db.Column(db.String(255), unique=True, nullable=False)
     is_primary = db.Column(db.Boolean, default=False, nullable=False)
 
@@ -1,222 +1,384 @@
-import logging as logger
-from sqlalchemy import event, Table, Column, ForeignKey
-from sqlalchemy.orm import scoped_session, sessionmaker, Session, attributes
+import logging
+from functools import lru_cache
+from itertools import chain
+from sqlalchemy import event
+from sqlalchemy.orm import Session, attributes, object_session
+from sqlalchemy.schema import CreateSchema, DropSchema
 from sqlalchemy.sql import text
 from .models import db
-from flask import g
+from .cache import invalidate_tenant
+from .context import current_tenant
 from .exceptions import *
 
-logger.basicConfig(level=logger.DEBUG)
+logger = logging.getLogger(__name__)
+
+# Tenant models whose flush listeners are already registered; registering twice would run the DDL twice
+_registered_tenant_models = set()
+
+# (table count when scanned, tenant-specific tables)
+_tenant_tables_cache = None
+
+# Engines whose public tenants/domains tables have been created
+_public_initialized = set()
+
+_DUPLICATE_SCHEMA = '42P06'
+_INVALID_SCHEMA_NAME = '3F000'
+
+# Bound form of SET search_path; the value is passed as a parameter instead of being spliced into the SQL
+_SET_SEARCH_PATH = "SELECT set_config('search_path', %s, false)"
+# Transaction-local variant for the DDL helpers, so the setting never outlives their engine.begin() block
+_SET_LOCAL_SEARCH_PATH = text("SELECT set_config('search_path', :path, true)")
+
+# Statements built once at import rather than on every call
+_SCHEMA_EXISTS = text("SELECT 1 FROM pg_catalog.pg_namespace WHERE nspname = :schema_name")
+# Both UPDATEs run as one statement, so the domains foreign key is checked after both rows change
+_RENAME_TENANT = text(
+    'WITH renamed AS (UPDATE tenants SET name = :new_name WHERE name = :old_name) '
+    'UPDATE domains SET tenant_name = :new_name WHERE tenant_name = :old_name'
+)
+
+
+def quote_identifier(name):
+    # Identifiers cannot be bound as parameters, so escape them with the dialect's preparer
+    return db.engine.dialect.identifier_preparer.quote_identifier(name)
+
+
+def _schema_state_error(e):
+    # Maps PostgreSQL's duplicate_schema / invalid_schema_name SQLSTATEs onto the typed schema exceptions,
+    # chained to the database error so the SQLSTATE stays reachable from the raised exception
+    orig = getattr(e, 'orig', None)
+    sqlstate = getattr(orig, 'pgcode', None) or getattr(orig, 'sqlstate', None)
+    if sqlstate == _DUPLICATE_SCHEMA:
+        error = SchemaAlreadyExistsError(str(orig).strip())
+    elif sqlstate == _INVALID_SCHEMA_NAME:
+        error = SchemaDoesNotExistError(str(orig).strip())
+    else:
+        return e
+    error.__cause__ = e
+    return error
 
 
 def schema_exists(schema_name):
-    session = scoped_session(sessionmaker(bind=db.engine))()
-    try:
-        result = session.execute(text(
-            "SELECT schema_name FROM information_schema.schemata WHERE schema_name = :schema_name"
-        ), {'schema_name': schema_name})
+    with db.engine.connect() as conn:
+        # pg_namespace is probed by its nspname index; information_schema.schemata joins and ACL-filters catalogs
+        result = conn.execute(_SCHEMA_EXISTS, {'schema_name': schema_name})
         return result.scalar() is not None
-    finally:
-        session.close()
 
 
-def create_schema(schema_name):
-    session = scoped_session(sessionmaker(bind=db.engine))()
-    try:
-        if schema_exists(schema_name):
-            raise SchemaAlreadyExistsError(f"Schema '{schema_name}' already exists")
+def create_schema(schema_name, conn=None):
+    # Runs on the caller's connection when given one, otherwise in a transaction of its own
+    if conn is not None:
+        return _create_schema(conn, schema_name)
+    with db.engine.begin() as conn:
+        _create_schema(conn, schema_name)
+
 
-        session.execute(text(f'CREATE SCHEMA IF NOT EXISTS "{schema_name}"'))
-        session.commit()
-        logger.info(f"Schema '{schema_name}' created successfully")
+def _create_schema(conn, schema_name):
+    try:
+        # No existence pre-check; PostgreSQL rejects an existing schema in the same round-trip
+        conn.execute(CreateSchema(schema_name))
+        logger.info("Schema '%s' created successfully", schema_name)
     except Exception as e:
-        session.rollback()
-        logger.error(f"Failed to create schema '{schema_name}': {e}")
-        raise SchemaCreationError(f"Failed to create schema: {e}")
-    finally:
-        session.close()
-
-def copy_column(column, **kwargs):
-    # Create a copy of the given column
-    # This includes basic attributes; adapt as needed for other properties like server defaults
-    copy_args = {}
-    # Preserve the type of the column
-    copy_args['type_'] = column.type
-    # If the column is a primary key
-    copy_args['primary_key'] = column.primary_key
-    # Copy nullable attribute
-    copy_args['nullable'] = column.nullable
-    # Copy default values
-    copy_args['default'] = column.default
-    # Copy autoincrement status
-    copy_args['autoincrement'] = column.autoincrement
-    # Foreign keys are more complex due to constraints relating to the table name
-    if column.foreign_keys:
-        # This assumes copying FKs in a way that's often but not always appropriate; be cautious
-        fk = next(iter(column.foreign_keys))
-        copy_args['foreign_keys'] = ForeignKey(fk.target_fullname)
-    # Allow overriding any attribute from kwargs
-    copy_args.update(kwargs)
-    
-    return Column(column.name, **copy_args)
-
-def create_tables(schema_name):
-    session = scoped_session(sessionmaker(bind=db.engine))()
+        error = _schema_state_error(e)
+        logger.error("Failed to create schema '%s': %s", schema_name, error)
+        raise SchemaCreationError(f"Failed to create schema: {error}") from error
+
+
+def _tenant_tables():
+    # Tenant-specific tables are fixed once models are declared; rescan only if more tables were registered
+    global _tenant_tables_cache
+    tables = db.Model.metadata.tables
+    if _tenant_tables_cache is None or _tenant_tables_cache[0] != len(tables):
+        _tenant_tables_cache = (len(tables), tuple(t for t in tables.values() if t.info.get('tenant_specific')))
+    return _tenant_tables_cache[1]
+
+
+def create_tables(schema_name, conn=None):
+    if conn is not None:
+        return _create_tables(conn, schema_name)
+    with db.engine.begin() as conn:
+        _create_tables(conn, schema_name)
+
+
+def _create_tables(conn, schema_name, checkfirst=True):
     try:
-        session.execute(text(f'SET search_path TO "{schema_name}", public'))
-        metadata = db.Model.metadata
-
-        tables_to_create = []
-        base_tables = list(metadata.tables.values())
-        for table in base_tables:
-            if table.info.get('tenant_specific'):
-                new_table = Table(
-                    table.name,
-                    metadata,
-                    *[copy_column(c) for c in table.columns],
-                    schema = schema_name,
-                    extend_existing=True
-                )
-                tables_to_create.append(new_table)
-
-        metadata.create_all(bind=session.bind, tables=tables_to_create)
-        logger.info(f"Tables created for schema '{schema_name}'")
+        # Tables declared with the 'tenant' placeholder schema are retargeted by schema_translate_map,
+        # so the shared metadata is never copied or mutated per tenant. Everything still emitted without
+        # a schema (schema-less tables, and the enum types and sequences even placeholder tables create)
+        # lands in the first search_path entry, which must be the tenant's own schema. {None: ...} can't be
+        # used instead: it would also move foreign keys to public tables
+        conn.execute(_SET_LOCAL_SEARCH_PATH, {'path': _tenant_search_path(schema_name)})
+        tenant_conn = conn.execution_options(schema_translate_map={'tenant': schema_name})
+        db.Model.metadata.create_all(bind=tenant_conn, tables=_tenant_tables(), checkfirst=checkfirst)
+        logger.info("Tables created for schema '%s'", schema_name)
     except Exception as e:
-        session.rollback()
-        logger.error(f"Failed to create tables for schema '{schema_name}': {e}")
+        logger.error("Failed to create tables for schema '%s': %s", schema_name, e)
         raise TableCreationError(f"Failed to create tables: {e}")
-    finally:
-        session.close()
 
 
 def create_public_tables():
-    session = scoped_session(sessionmaker(bind=db.engine))()
     try:
-        session.execute(text('SET search_path TO public'))
-        db.Model.metadata.create_all(bind=session.bind, tables=[
-            db.Model.metadata.tables['tenants'],
-            db.Model.metadata.tables['domains']
-        ])
+        with db.engine.begin() as conn:
+            conn.execute(_SET_LOCAL_SEARCH_PATH, {'path': 'public'})
+            db.Model.metadata.create_all(bind=conn, tables=[
+                db.Model.metadata.tables['tenants'],
+                db.Model.metadata.tables['domains']
+            ])
         logger.info("Public tables created successfully")
     except Exception as e:
-        session.rollback()
-        logger.error(f"Failed to create public tables: {e}")
+        logger.error("Failed to create public tables: %s", e)
         raise TableCreationError(f"Failed to create public tables: {e}")
-    finally:
-        session.close()
 
 
-def create_schema_and_tables(schema_name):
-    try:
-        create_schema(schema_name)
+def init_public_schema():
+    # create_all still introspects every table when they already exist, so only do it once per engine
+    engine = db.engine
+    if engine not in _public_initialized:
         create_public_tables()
-        create_tables(schema_name)
-    except SchemaCreationError as e:
-        logger.error(f"Schema creation error for '{schema_name}': {e}")
-        raise
-    except TableCreationError as e:
-        logger.error(f"Table creation error for '{schema_name}': {e}")
-        raise
+        _public_initialized.add(engine)
+
+
+def create_schema_and_tables(schema_name):
+    create_schemas_and_tables([schema_name])
+
+
+def create_schemas_and_tables(schema_names):
+    if not schema_names:
+        return
+
+    init_public_schema()
+    # One pool checkout and one transaction for the whole batch; any failure rolls back every schema in it
+    with db.engine.begin() as conn:
+        for schema_name in schema_names:
+            try:
+                _create_schema(conn, schema_name)
+                # The schema was created in this transaction, so there is nothing to check for
+                _create_tables(conn, schema_name, checkfirst=False)
+            except SchemaCreationError as e:
+                logger.error("Schema creation error for '%s': %s", schema_name, e)
+                raise
+            except TableCreationError as e:
+                logger.error("Table creation error for '%s': %s", schema_name, e)
+                raise
 
 
 def rename_schema_and_update_tables(old_name, new_name):
-    session = scoped_session(sessionmaker(bind=db.engine))()
     try:
-        if not schema_exists(old_name):
-            raise SchemaDoesNotExistError(f"Schema '{old_name}' does not exist")
-
-        if schema_exists(new_name):
-            raise SchemaAlreadyExistsError(f"Schema '{new_name}' already exists")
-
-        session.execute(text(f'ALTER SCHEMA "{old_name}" RENAME TO "{new_name}"'))
-        session.execute(text(f'UPDATE tenants SET name = :new_name WHERE name = :old_name').bindparams(
-            new_name=new_name, old_name=old_name))
-        session.execute(text(f'UPDATE domains SET tenant_name = :new_name WHERE tenant_name = :old_name').bindparams(
-            new_name=new_name, old_name=old_name))
-        session.commit()
-        logger.info(f"Schema renamed from '{old_name}' to '{new_name}' and updated tables")
+        # ALTER SCHEMA fails on its own if the old schema is missing or the new one exists
+        with db.engine.begin() as conn:
+            conn.execute(text(f'ALTER SCHEMA {quote_identifier(old_name)} RENAME TO {quote_identifier(new_name)}'))
+            conn.execute(_RENAME_TENANT, {'new_name': new_name, 'old_name': old_name})
+        logger.info("Schema renamed from '%s' to '%s' and updated tables", old_name, new_name)
     except Exception as e:
-        session.rollback()
-        logger.error(f"Failed to rename schema from '{old_name}' to '{new_name}': {e}")
-        raise SchemaRenameError(f"Failed to rename schema and update tables: {e}")
-    finally:
-        session.close()
+        error = _schema_state_error(e)
+        logger.error("Failed to rename schema from '%s' to '%s': %s", old_name, new_name, error)
+        raise SchemaRenameError(f"Failed to rename schema and update tables: {error}") from error
 
 
 def drop_schema(schema_name):
-    session = scoped_session(sessionmaker(bind=db.engine))()
-    try:
-        if not schema_exists(schema_name):
-            raise SchemaDoesNotExistError(f"Schema '{schema_name}' does not exist")
+    drop_schemas([schema_name])
+
 
-        session.execute(text(f'DROP SCHEMA IF EXISTS "{schema_name}" CASCADE'))
-        session.commit()
-        logger.info(f"Schema '{schema_name}' dropped successfully")
+def drop_schemas(schema_names):
+    # All drops share one transaction, so a failure leaves every schema in place
+    try:
+        with db.engine.begin() as conn:
+            for schema_name in schema_names:
+                conn.execute(DropSchema(schema_name, cascade=True))
+        logger.info("Schemas %s dropped successfully", schema_names)
     except Exception as e:
-        session.rollback()
-        logger.error(f"Failed to drop schema '{schema_name}': {e}")
-        raise SchemaDropError(f"Failed to drop schema: {e}")
-    finally:
-        session.close()
+        error = _schema_state_error(e)
+        logger.error("Failed to drop schemas %s: %s", schema_names, error)
+        raise SchemaDropError(f"Failed to drop schema: {error}") from error
 
 
 def register_event_listeners():
+    # The tenant model is fixed once the extension is initialised, so resolve it once for all listeners
+    tenant_model = getattr(db.Model, 'Tenant', None)
+    if tenant_model is None or tenant_model in _registered_tenant_models:
+        return
+    _registered_tenant_models.add(tenant_model)
+
+    # propagate=True so subclasses of the tenant model (e.g. polymorphic tenants) are covered too
+    @event.listens_for(tenant_model, 'after_insert', propagate=True)
+    @event.listens_for(tenant_model, 'after_delete', propagate=True)
+    def invalidate_cached_tenant(mapper, connection, target):
+        _invalidate_on_commit(target, [target.name])
+
+    @event.listens_for(tenant_model, 'after_update', propagate=True)
+    def invalidate_updated_tenant(mapper, connection, target):
+        _invalidate_on_commit(target, [*attributes.get_history(target, 'name').deleted, target.name])
+
+    # Most flushes carry no tenant rows; flag the sessions that have seen one so the flush
+    # listeners can skip scanning the others
+    @event.listens_for(Session, 'before_attach')
+    def flag_attached_tenant(session, instance):
+        if isinstance(instance, tenant_model):
+            session.info['_has_tenant'] = True
+
+    @event.listens_for(tenant_model, 'load', propagate=True)
+    def flag_loaded_tenant(target, context):
+        context.session.info['_has_tenant'] = True
+
+    @event.listens_for(tenant_model, 'refresh', propagate=True)
+    def reset_renamed_marker(target, context, attrs):
+        # Freshly loaded state supersedes the rename this instance last performed
+        target.__dict__.pop('_ft_renamed', None)
+
     @event.listens_for(Session, 'before_flush')
     def before_flush(session, flush_context, instances):
-        tenant_model = getattr(db.Model, 'Tenant', None)
-        session._already_renamed = getattr(session, '_already_renamed', set())
-
-        for instance in session.new:
-            if tenant_model and isinstance(instance, tenant_model):
-                try:
-                    create_schema_and_tables(instance.name)
-                except (SchemaCreationError, TableCreationError) as e:
-                    logger.error(f"Error creating schema and tables for new tenant '{instance.name}': {e}")
-                    raise
-
-        for instance in session.dirty:
-            if tenant_model and isinstance(instance, tenant_model):
-                history = attributes.get_history(instance, 'name')
-                if history.has_changes():
-                    old_name = history.deleted[0]
-                    new_name = history.added[0]
-                    if old_name != new_name and old_name not in session._already_renamed:
-                        try:
-                            rename_schema_and_update_tables(old_name, new_name)
-                            session._already_renamed.add(old_name)
-                        except SchemaRenameError as e:
-                            logger.error(f"Error renaming schema before flush: {e}")
-                            raise
+        if not session.info.get('_has_tenant'):
+            return
+        # One pass over new and dirty: pending instances have no identity key yet
+        new_tenants = []
+        renames = []
+        for instance in chain(session.new, session.dirty):
+            if not isinstance(instance, tenant_model):
+                continue
+            if attributes.instance_state(instance).key is None:
+                new_tenants.append(instance.name)
+                continue
+            history = attributes.get_history(instance, 'name')
+            if history.has_changes():
+                old_name = history.deleted[0]
+                new_name = history.added[0]
+                # The instance remembers the name it was last renamed from, so a flush that runs
+                # before_flush again for the same change does not repeat the ALTER SCHEMA
+                if old_name != new_name and instance.__dict__.get('_ft_renamed') != old_name:
+                    renames.append((instance, old_name, new_name))
+
+        if new_tenants:
+            # The schema of a tenant deleted earlier in this transaction is only dropped on commit
+            pending = {name for _, name in session.info.get('_pending_schema_drops', ())}
+            recreated = [name for name in new_tenants if name in pending]
+            if recreated:
+                logger.error("Tenants %s were deleted in this transaction; commit before recreating them", recreated)
+                raise SchemaCreationError(
+                    f"Schemas {recreated} are dropped when the deleting transaction commits; commit it first")
+            try:
+                create_schemas_and_tables(new_tenants)
+            except (SchemaCreationError, TableCreationError) as e:
+                logger.error("Error creating schemas and tables for new tenants %s: %s", new_tenants, e)
+                raise
+
+        for instance, old_name, new_name in renames:
+            try:
+                rename_schema_and_update_tables(old_name, new_name)
+                instance.__dict__['_ft_renamed'] = old_name
+            except SchemaRenameError as e:
+                logger.error("Error renaming schema before flush: %s", e)
+                raise
 
     @event.listens_for(Session, 'after_flush')
     def after_flush(session, flush_context):
-        tenant_model = getattr(db.Model, 'Tenant', None)
-
-        for instance in session.dirty:
-            if tenant_model and isinstance(instance, tenant_model):
-                history = attributes.get_history(instance, 'name')
-                if history.has_changes():
-                    new_name = history.added[0]
-                    if new_name in session._already_renamed:
-                        session._already_renamed.remove(new_name)
-
-        for instance in session.deleted:
-            if tenant_model and isinstance(instance, tenant_model):
-                schema_name = instance.name
-                try:
-                    drop_schema(schema_name)
-                except SchemaDropError as e:
-                    logger.error(f"Error dropping schema '{schema_name}': {e}")
-                    raise
+        if not session.info.get('_has_tenant'):
+            return
+        # Drops wait for the commit: running them here would block on the row locks this
+        # transaction holds, and a rollback could not bring the schema back
+        dropped = [instance.name for instance in session.deleted if isinstance(instance, tenant_model)]
+        if dropped:
+            # Tagged with the innermost transaction, so rolling back a savepoint only forgets its own deletes
+            transaction = session.get_nested_transaction() or session.get_transaction()
+            session.info.setdefault('_pending_schema_drops', []).extend(
+                (transaction, name) for name in dropped)
+
+    @event.listens_for(Session, 'after_commit')
+    def after_commit(session):
+        transaction = session.get_transaction()
+        if transaction is not None and transaction.is_active:
+            # Releasing a savepoint also fires after_commit; its drops now wait for the enclosing transaction
+            session.info['_released_savepoint'] = True
+            return
+        # A request that missed the cache between the flush and this commit cached the old row
+        for name in session.info.pop('_stale_tenants', ()):
+            invalidate_tenant(name)
+        pending = session.info.pop('_pending_schema_drops', None)
+        if pending:
+            dropped = [name for _, name in pending]
+            try:
+                drop_schemas(dropped)
+            except SchemaDropError as e:
+                # The deletes are already committed; raising here would report a failed commit that
+                # succeeded, so the schemas are left behind for manual cleanup instead
+                logger.error("Tenants %s were deleted but their schemas could not be dropped: %s", dropped, e)
+
+    @event.listens_for(Session, 'after_transaction_end')
+    def after_transaction_end(session, transaction):
+        # Covers rollback, close() and reset() alike: whatever ends a transaction without committing it
+        # also undoes the deletes queued inside it, so their schemas must stay
+        released = transaction.nested and session.info.pop('_released_savepoint', False)
+        if transaction.parent is None:
+            # A committed root transaction has already consumed both queues in after_commit
+            session.info.pop('_stale_tenants', None)
+            session.info.pop('_pending_schema_drops', None)
+            return
+        pending = session.info.get('_pending_schema_drops')
+        if not pending:
+            return
+        if released:
+            session.info['_pending_schema_drops'] = [
+                (transaction.parent if tagged is transaction else tagged, name) for tagged, name in pending]
+        elif transaction.nested:
+            kept = [entry for entry in pending if not _within_transaction(entry[0], transaction)]
+            if kept:
+                session.info['_pending_schema_drops'] = kept
+            else:
+                del session.info['_pending_schema_drops']
+
+
+def _invalidate_on_commit(target, names):
+    # Invalidated now and again once the change commits: until then, a cache miss still reads the old row
+    for name in names:
+        invalidate_tenant(name)
+    session = object_session(target)
+    if session is not None:
+        session.info.setdefault('_stale_tenants', set()).update(names)
+
+
+def _within_transaction(transaction, ancestor):
+    while transaction is not None:
+        if transaction is ancestor:
+            return True
+        transaction = transaction.parent
+    return False
+
+
+@lru_cache(maxsize=4096)
+def _tenant_search_path(schema_name):
+    # Quoted once per tenant rather than on every transaction
+    return '"%s", public' % schema_name.replace('"', '""')
+
+
+def _set_search_path(conn):
+    # Runs once per transaction rather than before every statement; the raw DBAPI cursor
+    # bypasses SQLAlchemy's execution events so this cannot recurse
+    tenant = current_tenant()
+    if tenant is not None:
+        schema = tenant.name
+        path = _tenant_search_path(schema)
+    else:
+        schema = 'public'
+        path = 'public'
+
+    cursor = conn.connection.cursor()
+    try:
+        cursor.execute(_SET_SEARCH_PATH, (path,))
+    finally:
+        cursor.close()
+
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("Set search_path to %s", schema)
+
+
+def refresh_search_path(session):
+    # A transaction that began before the tenant was resolved kept the search_path chosen at its start
+    if session.in_transaction():
+        tenant = current_tenant()
+        path = _tenant_search_path(tenant.name) if tenant is not None else 'public'
+        session.connection().exec_driver_sql(_SET_SEARCH_PATH, (path,))
 
 
 def register_engine_event_listeners(engine):
-    @event.listens_for(engine, 'before_cursor_execute')
-    def set_search_path(conn, cursor, statement, parameters, context, executemany):
-        if hasattr(g, 'tenant_scoped') and g.tenant_scoped:
-            schema = g.tenant
-            cursor.execute(f'SET search_path TO {schema}, public')
-            logger.debug(f"Set search_path to {schema}")
-        else:
-            cursor.execute('SET search_path TO public')
-            logger.debug("Set search_path to public")
+    # Repeated init calls must not stack a second search_path statement onto every transaction
+    if not event.contains(engine, 'begin', _set_search_path):
+        event.listen(engine, 'begin', _set_search_path)